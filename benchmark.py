@@ -0,0 +1,279 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from bitfield_manager import BitfieldManager
+from disk_writer import DiskWriter
+from message_handler import MessageHandler
+from swarm import Swarm, DEFAULT_CONTENT_ID
+from utils import recv_all
+
+PIECE_COUNTS = [1_000, 10_000, 100_000, 1_000_000]
+PAYLOAD_SIZES = [16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+QUICK_PIECE_COUNTS = [1_000, 10_000]
+QUICK_PAYLOAD_SIZES = [16 * 1024, 256 * 1024]
+BENCH_PEER_ID = 9999
+
+
+def measure(func, min_time, repeats, warmup):
+    """
+    Time func, calling it enough times per round that a round lasts at least min_time.
+    Returns per-call statistics in seconds over all rounds.
+    """
+    for _ in range(warmup):
+        func()
+    # Calibrate the number of calls per round
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    samples.sort()
+    return {
+        'calls_per_round': number,
+        'rounds': repeats,
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        'max': samples[-1],
+    }
+
+
+def make_swarm(num_pieces, piece_size=16384):
+    config = {
+        'num_preferred_neighbors': 1,
+        'unchoking_interval': 5,
+        'optimistic_unchoking_interval': 15,
+        'file_name': 'bench.dat',
+        'file_size': num_pieces * piece_size,
+        'piece_size': piece_size,
+        'super_seeding': 0,
+        'disk_writer_threads': 1,
+        'disk_queue_size': 1,
+        'streaming_mode': 0,
+        'streaming_lookahead': 16,
+        'streaming_random_ratio': 0.2,
+        'request_timeout': 10,
+        'keep_alive_interval': 10,
+        'idle_timeout': 30,
+    }
+    disk_writer = DiskWriter(config['disk_writer_threads'], config['disk_queue_size'])
+    return Swarm(BENCH_PEER_ID, DEFAULT_CONTENT_ID, config, 0, disk_writer)
+
+
+def make_message_handler(swarm, peer_bitfield):
+    # Only the fields the handler reads, the benchmark never touches a real socket
+    peer_connection = SimpleNamespace(
+        peer_id=BENCH_PEER_ID + 1,
+        swarm=swarm,
+        peer_bitfield=peer_bitfield,
+        lock=threading.Lock(),
+    )
+    return MessageHandler(peer_connection)
+
+
+def bitfield_cases(num_pieces):
+    rng = random.Random(num_pieces)
+    half_bitfield = [rng.randint(0, 1) for _ in range(num_pieces)]
+    encoded = BitfieldManager.encode_bitfield(half_bitfield)
+    # Everything but the last piece, so is_complete has to scan the whole bitfield
+    manager = BitfieldManager(num_pieces)
+    manager.set_all()
+    manager.local_bitfield[-1] = 0
+
+    yield 'encode_bitfield', lambda: BitfieldManager.encode_bitfield(half_bitfield)
+    yield 'decode_bitfield', lambda: BitfieldManager.decode_bitfield(encoded, num_pieces)
+    yield 'is_complete', manager.is_complete
+    yield 'count_pieces', manager.count_pieces
+
+
+def selection_cases(num_pieces):
+    rng = random.Random(num_pieces)
+    swarm = make_swarm(num_pieces)
+    swarm.bitfield_manager.local_bitfield = [rng.randint(0, 1) for _ in range(num_pieces)]
+    # The remote peer has everything, so about half of the pieces are candidates
+    select_handler = make_message_handler(swarm, [1] * num_pieces)
+    # The remote peer has exactly what we have, so the interest check finds nothing and scans every piece
+    interest_handler = make_message_handler(swarm, list(swarm.bitfield_manager.local_bitfield))
+
+    yield 'select_piece', select_handler.select_piece
+    yield 'is_interested_in_peer', interest_handler.is_interested_in_peer
+
+
+def framing_case(payload_size):
+    sender, receiver = socket.socketpair()
+    message = (payload_size + 5).to_bytes(4, 'big') + b'\x07' + (0).to_bytes(4, 'big') + os.urandom(payload_size)
+
+    def send_forever():
+        # Socket buffers throttle the sender to the pace of the receiver
+        try:
+            while True:
+                sender.sendall(message)
+        except OSError:
+            pass
+
+    threading.Thread(target=send_forever, daemon=True).start()
+
+    def receive_message():
+        # Same framing as PeerConnection.handle_messages
+        message_length = int.from_bytes(recv_all(receiver, 4), 'big')
+        recv_all(receiver, 1)
+        recv_all(receiver, message_length - 1)
+
+    return receive_message, (sender, receiver)
+
+
+def storage_cases(payload_size):
+    swarm = make_swarm(64, payload_size)
+    handler = make_message_handler(swarm, [0] * swarm.num_pieces)
+    piece_data = os.urandom(payload_size)
+    disk_writer = swarm.disk_writer
+    disk_writer.write_batch([(swarm, 0, piece_data, None)])
+    counter = iter(range(sys.maxsize))
+
+    def write_batch(batch_size):
+        start = next(counter) * batch_size
+        disk_writer.write_batch([
+            (swarm, (start + i) % swarm.num_pieces, piece_data, None) for i in range(batch_size)
+        ])
+
+    yield 'write_batch', {'batch': 1}, lambda: write_batch(1)
+    yield 'write_batch', {'batch': disk_writer.batch_size}, lambda: write_batch(disk_writer.batch_size)
+    yield 'get_piece', {}, lambda: handler.get_piece(0)
+
+
+def run_benchmarks(piece_counts, payload_sizes, min_time, repeats, warmup):
+    results = {}
+
+    def record(name, params, func):
+        key = name + ''.join(f"[{param}={value}]" for param, value in params.items())
+        # The hot paths print as they go, keep the formatting cost but not the terminal output
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            stats = measure(func, min_time, repeats, warmup)
+        results[key] = {'name': name, 'params': params, **stats}
+        print(f"{key:<55} min {format_seconds(stats['min']):>10}  median {format_seconds(stats['median']):>10}  "
+              f"stdev {format_seconds(stats['stdev']):>10}  ({stats['calls_per_round']} calls x {repeats})")
+
+    for num_pieces in piece_counts:
+        for name, func in bitfield_cases(num_pieces):
+            record(name, {'pieces': num_pieces}, func)
+        for name, func in selection_cases(num_pieces):
+            record(name, {'pieces': num_pieces}, func)
+    for payload_size in payload_sizes:
+        receive_message, sockets = framing_case(payload_size)
+        try:
+            record('recv_all_framing', {'payload': payload_size}, receive_message)
+        finally:
+            for sock in sockets:
+                sock.close()
+        for name, params, func in storage_cases(payload_size):
+            record(name, {'payload': payload_size, **params}, func)
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance, statistic):
+    """
+    Print the change of every result against the baseline and return the keys that got slower than tolerance allows.
+    """
+    regressions = []
+    print(f"\n{'Benchmark':<55} {'Baseline':>10} {'Current':>10} {'Change':>8}")
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            print(f"{key:<55} {'-':>10} {format_seconds(result[statistic]):>10} {'new':>8}")
+            continue
+        change = result[statistic] / previous[statistic] - 1
+        flag = ''
+        if change > tolerance:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print(f"{key:<55} {format_seconds(previous[statistic]):>10} "
+              f"{format_seconds(result[statistic]):>10} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def format_seconds(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the protocol and data-structure hot paths.")
+    parser.add_argument('--quick', action='store_true', help="only run the small piece counts and payload sizes")
+    parser.add_argument('--pieces', type=int, nargs='+', help="piece counts to benchmark")
+    parser.add_argument('--payloads', type=int, nargs='+', help="payload sizes in bytes to benchmark")
+    parser.add_argument('--min-time', type=float, default=0.05, help="minimum duration of one timed round in seconds")
+    parser.add_argument('--repeats', type=int, default=7, help="number of timed rounds")
+    parser.add_argument('--warmup', type=int, default=2, help="untimed calls before calibration")
+    parser.add_argument('--output', default='benchmark_results.json', help="where to write the JSON results")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown against the baseline before it counts as a regression")
+    parser.add_argument('--statistic', choices=['min', 'median', 'mean'], default='min',
+                        help="per-call statistic compared against the baseline, min is the least noisy")
+    args = parser.parse_args()
+
+    piece_counts = args.pieces or (QUICK_PIECE_COUNTS if args.quick else PIECE_COUNTS)
+    payload_sizes = args.payloads or (QUICK_PAYLOAD_SIZES if args.quick else PAYLOAD_SIZES)
+    output_path = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+
+    # Pieces are stored relative to the working directory, keep them out of the repository
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            results = run_benchmarks(piece_counts, payload_sizes, args.min_time, args.repeats, args.warmup)
+        finally:
+            os.chdir(cwd)
+
+    with open(output_path, 'w') as f:
+        json.dump({
+            'meta': {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'min_time': args.min_time,
+                'repeats': args.repeats,
+                'warmup': args.warmup,
+            },
+            'results': results,
+        }, f, indent=2)
+    print(f"\nWrote results to {output_path}")
+
+    if baseline is not None:
+        regressions = compare_with_baseline(results, baseline, args.tolerance, args.statistic)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,70 @@
 import threading
+from profiler import profiler, ProfiledLock
 
 class BitfieldManager:
     def __init__(self, num_pieces):
         self.num_pieces = num_pieces
         self.local_bitfield = [0] * num_pieces
-        self.lock = threading.Lock()
+        self.lock = ProfiledLock('BitfieldManager.lock')
+        self.piece_added = threading.Condition(self.lock)  # Notified whenever a piece is added
+        self.prefix_pieces = 0  # Number of pieces we have from the start of the file without a gap
 
     def set_all(self):
         self.local_bitfield = [1] * self.num_pieces
+        self.prefix_pieces = self.num_pieces
 
+    @profiler.timed('BitfieldManager.update_bitfield')
     def update_bitfield(self, piece_index):
         with self.lock:
             self.local_bitfield[piece_index] = 1
+            while self.prefix_pieces < self.num_pieces and self.local_bitfield[self.prefix_pieces] == 1:
+                self.prefix_pieces += 1
+            self.piece_added.notify_all()
 
+    def contiguous_pieces(self):
+        with self.lock:
+            return self.prefix_pieces
+
+    def wait_for_prefix(self, num_pieces, timeout=None):
+        """
+        Block until the first num_pieces pieces are all present. Returns False on timeout.
+        """
+        with self.piece_added:
+            return self.piece_added.wait_for(lambda: self.prefix_pieces >= num_pieces, timeout)
+
+    def wait_for_piece(self, piece_index, timeout=None):
+        """
+        Block until the piece is present. Returns False on timeout.
+        """
+        with self.piece_added:
+            return self.piece_added.wait_for(lambda: self.local_bitfield[piece_index] == 1, timeout)
+
+    def present_run_end(self, piece_index):
+        """
+        Index of the first missing piece at or after piece_index, or num_pieces if there is none.
+        """
+        with self.lock:
+            index = max(piece_index, self.prefix_pieces)
+            while index < self.num_pieces and self.local_bitfield[index] == 1:
+                index += 1
+            return index
+
+    @profiler.timed('BitfieldManager.is_complete')
     def is_complete(self):
         with self.lock:
             return all(self.local_bitfield)
 
+    @profiler.timed('BitfieldManager.has_piece')
     def has_piece(self, piece_index):
         with self.lock:
             return self.local_bitfield[piece_index] == 1
 
+    @profiler.timed('BitfieldManager.count_pieces')
     def count_pieces(self):
         with self.lock:
             return sum(self.local_bitfield)
 
+    @profiler.timed('BitfieldManager.generate_bitfield_message')
     def generate_bitfield_message(self):
         with self.lock:
             bitfield_bytes = self.encode_bitfield(self.local_bitfield)
@@ -33,6 +73,7 @@ class BitfieldManager:
         return message_length + message_type + bitfield_bytes
 
     @staticmethod
+    @profiler.timed('BitfieldManager.encode_bitfield')
     def encode_bitfield(bitfield):
         bitfield_bytes = bytearray()
         for byte_index in range(0, len(bitfield), 8):
@@ -44,6 +85,7 @@ class BitfieldManager:
         return bytes(bitfield_bytes)
 
     @staticmethod
+    @profiler.timed('BitfieldManager.decode_bitfield')
     def decode_bitfield(bitfield_bytes, num_pieces):
         bitfield = []
         total_bits = num_pieces
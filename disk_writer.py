@@ -0,0 +1,140 @@
+import os
+import queue
+import threading
+from utils import log_event
+from profiler import profiler
+
+
+class DiskWriter:
+    """
+    Write-behind stage between the connection threads and the disk, shared by every swarm of the process.
+    Received pieces are queued and written by a small pool of writer threads, which drain whatever is
+    queued into one batch and fsync the batch together. Once a piece is durable the writer adds it to the
+    bitfield, and its callback runs on a separate notifier thread, so the network I/O of the callbacks
+    ('have' messages, assembling the file) never holds up the disk. When the queue is full, submit blocks,
+    which stops reading from that socket.
+    Each queued piece carries its swarm, which decides where the piece is stored and where errors are logged.
+    """
+
+    def __init__(self, num_threads=2, queue_size=64, batch_size=16):
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = set()  # (content_id, piece_index) of pieces queued or being written
+        self.lock = threading.Lock()
+        self.notify_queue = queue.Queue()  # (piece_index, on_durable) of pieces that are in the bitfield
+        for i in range(num_threads):
+            threading.Thread(target=self.writer_task, name=f"disk-writer-{i}", daemon=True).start()
+        threading.Thread(target=self.notifier_task, name="disk-notifier", daemon=True).start()
+
+    def submit(self, swarm, piece_index, piece_data, on_durable):
+        """
+        Queue a piece of a swarm for writing. Returns False if the piece is already queued or being written.
+        """
+        with self.lock:
+            if (swarm.content_id, piece_index) in self.pending:
+                return False
+            self.pending.add((swarm.content_id, piece_index))
+        item = (swarm, piece_index, piece_data, on_durable)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            print(f"Disk writer of Peer {swarm.peer_id} is behind, waiting to queue piece {piece_index}")
+            self.queue.put(item)
+        return True
+
+    def is_pending(self, swarm, piece_index):
+        with self.lock:
+            return (swarm.content_id, piece_index) in self.pending
+
+    def pending_pieces(self, swarm):
+        with self.lock:
+            return {piece_index for content_id, piece_index in self.pending if content_id == swarm.content_id}
+
+    def writer_task(self):
+        while True:
+            batch = [self.queue.get()]
+            # Coalesce everything else that is already waiting into the same batch
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            durable = self.write_batch(batch)
+            # Pieces stay pending until they are in the bitfield, so they are never requested twice
+            for swarm, piece_index, on_durable in durable:
+                swarm.bitfield_manager.update_bitfield(piece_index)
+            with self.lock:
+                for swarm, piece_index, _, _ in batch:
+                    self.pending.discard((swarm.content_id, piece_index))
+            for swarm, piece_index, on_durable in durable:
+                self.notify_queue.put((piece_index, on_durable))
+
+    def notifier_task(self):
+        while True:
+            piece_index, on_durable = self.notify_queue.get()
+            try:
+                on_durable(piece_index)
+            except Exception as e:
+                print(f"Error after saving piece {piece_index}: {e}")
+                import traceback
+                traceback.print_exc()
+
+    @profiler.timed('DiskWriter.write_batch')
+    def write_batch(self, batch):
+        """
+        Write a batch of pieces and fsync them. Returns (swarm, piece_index, on_durable) for every piece that made it to disk.
+        Each piece is written to a temporary file that replaces the piece file once synced, so a piece
+        that is being read or sent is never truncated. Pieces we already have are skipped.
+        """
+        written = []
+        for swarm, piece_index, piece_data, on_durable in batch:
+            if swarm.bitfield_manager.has_piece(piece_index):
+                continue
+            temp_path = swarm.piece_path(piece_index) + '.part'
+            try:
+                piece_file = open(temp_path, 'wb')
+            except OSError as e:
+                self.report_error(swarm, piece_index, e)
+                continue
+            try:
+                piece_file.write(piece_data)
+                piece_file.flush()
+            except OSError as e:
+                piece_file.close()
+                self.report_error(swarm, piece_index, e)
+                continue
+            written.append((swarm, piece_index, on_durable, piece_file, temp_path))
+
+        # Batched fsync: one pass once every piece of the batch has been written
+        durable = []
+        for swarm, piece_index, on_durable, piece_file, temp_path in written:
+            try:
+                os.fsync(piece_file.fileno())
+                piece_file.close()
+                os.replace(temp_path, swarm.piece_path(piece_index))
+                durable.append((swarm, piece_index, on_durable))
+            except OSError as e:
+                piece_file.close()
+                self.report_error(swarm, piece_index, e)
+        for pieces_dir in {swarm.pieces_dir for swarm, _, _ in durable}:
+            self.sync_directory(pieces_dir)
+        return durable
+
+    def sync_directory(self, pieces_dir):
+        # New directory entries are only durable once the directory itself is synced (not possible on Windows)
+        if not hasattr(os, 'O_DIRECTORY'):
+            return
+        try:
+            dir_fd = os.open(pieces_dir, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+    def report_error(self, swarm, piece_index, error):
+        print(f"Error saving piece {piece_index}: {error}")
+        log_event(swarm.log_id, f"Error saving piece {piece_index}: {error}")
@@ -1,31 +1,53 @@
-import os
 import random
+import time
 from utils import recv_all, log_event
 from bitfield_manager import BitfieldManager
+from profiler import profiler
+
+# Timer labels for handle_message, indexed by message type
+MESSAGE_TIMER_LABELS = tuple(
+    f"MessageHandler.handle_message[{name}]"
+    for name in ('choke', 'unchoke', 'interested', 'not interested', 'have', 'bitfield', 'request', 'piece')
+)
+HANDSHAKE_KEEP_ALIVES = 0x01  # Flag: the sender understands zero-length keep-alive messages
 
 
 class MessageHandler:
     def __init__(self, peer_connection):
         self.peer_connection = peer_connection
-        self.peer_process = peer_connection.peer_process
+        self.swarm = peer_connection.swarm
 
     @staticmethod
-    def send_handshake(peer_socket, peer_id):
-        handshake_message = b'P2PFILESHARINGPROJ' + b'\x00' * 10 + peer_id.to_bytes(4, 'big')
+    def send_handshake(peer_socket, peer_id, content_id=0):
+        # The content id of the swarm goes into the last 4 of the 10 zero bytes, the flags into the byte before it
+        handshake_message = (b'P2PFILESHARINGPROJ' + b'\x00' * 5 + bytes([HANDSHAKE_KEEP_ALIVES])
+                             + content_id.to_bytes(4, 'big') + peer_id.to_bytes(4, 'big'))
         peer_socket.sendall(handshake_message)
 
     @staticmethod
     def receive_handshake(peer_socket):
+        """
+        Returns (peer_id, content_id, flags), or (None, None, 0) if the handshake is invalid.
+        """
         message = recv_all(peer_socket, 32)
         if not message:
-            return None
+            return None, None, 0
         header = message[:18]
         if header != b'P2PFILESHARINGPROJ':
-            return None
+            return None, None, 0
+        flags = message[23]
+        content_id = int.from_bytes(message[24:28], 'big')
         peer_id = int.from_bytes(message[28:], 'big')
-        return peer_id
+        return peer_id, content_id, flags
 
     def handle_message(self, message_type, payload):
+        if profiler.enabled and message_type < len(MESSAGE_TIMER_LABELS):
+            with profiler.timer(MESSAGE_TIMER_LABELS[message_type]):
+                self.dispatch_message(message_type, payload)
+        else:
+            self.dispatch_message(message_type, payload)
+
+    def dispatch_message(self, message_type, payload):
         if message_type == 0:  # choke
             self.handle_choke()
         elif message_type == 1:  # unchoke
@@ -47,14 +69,14 @@ class MessageHandler:
 
     def handle_choke(self):
         print(f"Received 'choke' from Peer {self.peer_connection.peer_id}")
-        log_event(self.peer_process.peer_id, f"Peer {self.peer_process.peer_id} is choked by Peer {self.peer_connection.peer_id}")
+        log_event(self.swarm.log_id, f"Peer {self.swarm.peer_id} is choked by Peer {self.peer_connection.peer_id}")
         with self.peer_connection.lock:
             self.peer_connection.peer_choking = True  # This peer is choked by the remote peer
             self.peer_connection.pending_requests.clear()  # Clear any pending requests
 
     def handle_unchoke(self):
         print(f"Received 'unchoke' from Peer {self.peer_connection.peer_id}")
-        log_event(self.peer_process.peer_id, f"Peer {self.peer_process.peer_id} is unchoked by Peer {self.peer_connection.peer_id}")
+        log_event(self.swarm.log_id, f"Peer {self.swarm.peer_id} is unchoked by Peer {self.peer_connection.peer_id}")
         with self.peer_connection.lock:
             self.peer_connection.peer_choking = False  # This peer is unchoked by the remote peer
         # Start requesting pieces
@@ -62,21 +84,21 @@ class MessageHandler:
 
     def handle_interested(self):
         print(f"Received 'interested' from Peer {self.peer_connection.peer_id}")
-        log_event(self.peer_process.peer_id, f"Peer {self.peer_process.peer_id} received the 'interested' message from Peer {self.peer_connection.peer_id}")
+        log_event(self.swarm.log_id, f"Peer {self.swarm.peer_id} received the 'interested' message from Peer {self.peer_connection.peer_id}")
         with self.peer_connection.lock:
             self.peer_connection.is_interested_in_us = True
 
     def handle_not_interested(self):
         print(f"Received 'not interested' from Peer {self.peer_connection.peer_id}")
-        log_event(self.peer_process.peer_id, f"Peer {self.peer_process.peer_id} received the 'not interested' message from Peer {self.peer_connection.peer_id}")
+        log_event(self.swarm.log_id, f"Peer {self.swarm.peer_id} received the 'not interested' message from Peer {self.peer_connection.peer_id}")
         with self.peer_connection.lock:
             self.peer_connection.is_interested_in_us = False
 
     def handle_have(self, payload):
         piece_index = int.from_bytes(payload, 'big')
         print(f"Received 'have' from Peer {self.peer_connection.peer_id} for piece {piece_index}")
-        log_event(self.peer_process.peer_id,
-                  f"Peer {self.peer_process.peer_id} received the 'have' message from Peer {self.peer_connection.peer_id} for the piece {piece_index}")
+        log_event(self.swarm.log_id,
+                  f"Peer {self.swarm.peer_id} received the 'have' message from Peer {self.peer_connection.peer_id} for the piece {piece_index}")
         # Update the peer's bitfield
         with self.peer_connection.lock:
             self.peer_connection.peer_bitfield[piece_index] = 1
@@ -86,10 +108,16 @@ class MessageHandler:
             if all(self.peer_connection.peer_bitfield):
                 self.peer_connection.has_complete_file = True
 
+        if self.swarm.super_seeder:
+            self.swarm.super_seeder.handle_have(self.peer_connection, piece_index)
+
         # Determine if we are now interested
-        if not self.peer_process.bitfield_manager.has_piece(piece_index):
+        if not self.swarm.bitfield_manager.has_piece(piece_index):
             if not self.peer_connection.am_interested_in_peer:
                 self.send_interested()
+            # An unchoked, idle connection would otherwise wait for the next unchoke to request it
+            if not self.peer_connection.peer_choking and not self.peer_connection.pending_requests:
+                self.request_piece()
         else:
             # Check if we are no longer interested in any pieces from this peer
             if self.peer_connection.am_interested_in_peer:
@@ -97,10 +125,12 @@ class MessageHandler:
                     self.send_not_interested()
 
     def handle_bitfield(self, payload):
-        self.peer_connection.peer_bitfield = BitfieldManager.decode_bitfield(payload, self.peer_process.num_pieces)
+        self.peer_connection.peer_bitfield = BitfieldManager.decode_bitfield(payload, self.swarm.num_pieces)
         print(f"Received bitfield from Peer {self.peer_connection.peer_id}: {self.peer_connection.peer_bitfield}")
-        log_event(self.peer_process.peer_id,
-                  f"Peer {self.peer_process.peer_id} received 'bitfield' message from Peer {self.peer_connection.peer_id}")
+        log_event(self.swarm.log_id,
+                  f"Peer {self.swarm.peer_id} received 'bitfield' message from Peer {self.peer_connection.peer_id}")
+        if self.swarm.super_seeder:
+            self.swarm.super_seeder.handle_bitfield(self.peer_connection)
         # Determine if we are interested
         if self.is_interested_in_peer():
             self.send_interested()
@@ -110,10 +140,10 @@ class MessageHandler:
     def handle_request(self, payload):
         piece_index = int.from_bytes(payload, 'big')
         print(f"Received 'request' from Peer {self.peer_connection.peer_id} for piece {piece_index}")
-        log_event(self.peer_process.peer_id,
-                  f"Peer {self.peer_process.peer_id} received 'request' message from Peer {self.peer_connection.peer_id} for piece {piece_index}")
+        log_event(self.swarm.log_id,
+                  f"Peer {self.swarm.peer_id} received 'request' message from Peer {self.peer_connection.peer_id} for piece {piece_index}")
         # Send the piece if we have it
-        if self.peer_process.bitfield_manager.has_piece(piece_index):
+        if self.swarm.bitfield_manager.has_piece(piece_index):
             self.send_piece(piece_index)
         else:
             print(f"Requested piece {piece_index} not found.")
@@ -122,28 +152,34 @@ class MessageHandler:
         piece_index = int.from_bytes(payload[:4], 'big')
         piece_data = payload[4:]
         print(f"Received 'piece' from Peer {self.peer_connection.peer_id} for piece {piece_index}")
-        # Save the piece
-        self.save_piece(piece_index, piece_data)
-        # Update bitfield
-        self.peer_process.bitfield_manager.update_bitfield(piece_index)
+        # Hand the piece to the disk writer, the bitfield is only updated once it is durable
+        if not self.swarm.bitfield_manager.has_piece(piece_index):
+            self.swarm.disk_writer.submit(self.swarm, piece_index, piece_data, self.handle_piece_saved)
 
-        # Remove from pending requests
+        # Remove from pending requests, the time it took is a latency sample for this peer
         with self.peer_connection.lock:
             self.peer_connection.downloaded_bytes += len(piece_data)
-            if piece_index in self.peer_connection.pending_requests:
-                self.peer_connection.pending_requests.remove(piece_index)
+            requested_at = self.peer_connection.pending_requests.pop(piece_index, None)
+            if requested_at is not None:
+                self.peer_connection.record_round_trip(time.monotonic() - requested_at)
+        # Request next piece
+        self.request_piece()
+
+    def handle_piece_saved(self, piece_index):
+        # Runs on the disk notifier thread once the piece is durable and in the bitfield
         # Log the event
-        num_pieces = self.peer_process.bitfield_manager.count_pieces()
-        log_event(self.peer_process.peer_id, f"Peer {self.peer_process.peer_id} has downloaded the piece {piece_index} from Peer {self.peer_connection.peer_id}. Now the number of pieces it has is {num_pieces}")
+        num_pieces = self.swarm.bitfield_manager.count_pieces()
+        log_event(self.swarm.log_id, f"Peer {self.swarm.peer_id} has downloaded the piece {piece_index} from Peer {self.peer_connection.peer_id}. Now the number of pieces it has is {num_pieces}")
         # Send 'have' messages to other peers
         self.send_have_to_all(piece_index)
-        # Request next piece
-        self.request_piece()
 
         # Check if all pieces are downloaded
-        if self.peer_process.bitfield_manager.is_complete():
-            self.peer_process.has_complete_file = True  # Update the flag
-            self.peer_process.assemble_file_from_pieces()
+        if self.swarm.bitfield_manager.is_complete():
+            with self.swarm.lock:
+                if self.swarm.has_complete_file:
+                    return  # Already assembled
+                self.swarm.has_complete_file = True  # Update the flag
+            self.swarm.assemble_file_from_pieces()
 
     def send_interested(self):
         message = (1).to_bytes(4, 'big') + b'\x02'
@@ -151,8 +187,8 @@ class MessageHandler:
         with self.peer_connection.lock:
             self.peer_connection.am_interested_in_peer = True
         print(f"Sent 'interested' to Peer {self.peer_connection.peer_id}")
-        log_event(self.peer_process.peer_id,
-                  f"Peer {self.peer_process.peer_id} sent 'interested' message to Peer {self.peer_connection.peer_id}")
+        log_event(self.swarm.log_id,
+                  f"Peer {self.swarm.peer_id} sent 'interested' message to Peer {self.peer_connection.peer_id}")
 
     def send_not_interested(self):
         message = (1).to_bytes(4, 'big') + b'\x03'
@@ -160,29 +196,39 @@ class MessageHandler:
         with self.peer_connection.lock:
             self.peer_connection.am_interested_in_peer = False
         print(f"Sent 'not interested' to Peer {self.peer_connection.peer_id}")
-        log_event(self.peer_process.peer_id,
-                  f"Peer {self.peer_process.peer_id} sent 'not interested' message to Peer {self.peer_connection.peer_id}")
+        log_event(self.swarm.log_id,
+                  f"Peer {self.swarm.peer_id} sent 'not interested' message to Peer {self.peer_connection.peer_id}")
+
+    def send_have(self, piece_index):
+        message = (5).to_bytes(4, 'big') + b'\x04' + piece_index.to_bytes(4, 'big')
+        self.peer_connection.socket.sendall(message)
+        print(f"Sent 'have' for piece {piece_index} to Peer {self.peer_connection.peer_id}")
+        log_event(self.swarm.log_id,
+                  f"Peer {self.swarm.peer_id} sent the 'have' message to Peer {self.peer_connection.peer_id} for the piece {piece_index}")
 
     def send_have_to_all(self, piece_index):
         message = (5).to_bytes(4, 'big') + b'\x04' + piece_index.to_bytes(4, 'big')
-        with self.peer_process.lock:
-            connections = list(self.peer_process.connections.values())
+        with self.swarm.lock:
+            connections = list(self.swarm.connections.values())
         for conn in connections:
             try:
                 conn.socket.sendall(message)
                 print(f"Sent 'have' for piece {piece_index} to Peer {conn.peer_id}")
-                log_event(self.peer_process.peer_id,
-                          f"Peer {self.peer_process.peer_id} sent the 'have' message to Peer {conn.peer_id} for the piece {piece_index}")
+                log_event(self.swarm.log_id,
+                          f"Peer {self.swarm.peer_id} sent the 'have' message to Peer {conn.peer_id} for the piece {piece_index}")
             except Exception as e:
                 print(f"Error sending 'have' message to Peer {conn.peer_id}: {e}")
 
+    @profiler.timed('MessageHandler.is_interested_in_peer')
     def is_interested_in_peer(self):
         with self.peer_connection.lock:
             peer_bitfield = self.peer_connection.peer_bitfield.copy()
-        with self.peer_process.bitfield_manager.lock:
-            local_bitfield = self.peer_process.bitfield_manager.local_bitfield.copy()
-        for index in range(self.peer_process.num_pieces):
-            if peer_bitfield[index] == 1 and local_bitfield[index] == 0:
+        with self.swarm.bitfield_manager.lock:
+            local_bitfield = self.swarm.bitfield_manager.local_bitfield.copy()
+        # Pieces waiting for the disk writer are received already
+        pending_writes = self.swarm.disk_writer.pending_pieces(self.swarm)
+        for index in range(self.swarm.num_pieces):
+            if peer_bitfield[index] == 1 and local_bitfield[index] == 0 and index not in pending_writes:
                 return True
         return False
 
@@ -191,29 +237,68 @@ class MessageHandler:
             return
         piece_index = self.select_piece()
         if piece_index is not None:
-            message = (5).to_bytes(4, 'big') + b'\x06' + piece_index.to_bytes(4, 'big')  # Request message
-            self.peer_connection.socket.sendall(message)
-            with self.peer_connection.lock:
-                self.peer_connection.pending_requests.append(piece_index)
-            print(f"Requested piece {piece_index} from Peer {self.peer_connection.peer_id}")
-            log_event(self.peer_process.peer_id, f"Peer {self.peer_process.peer_id} requested piece {piece_index} from Peer {self.peer_connection.peer_id}")
-        else:
+            self.send_request(piece_index)
+            return
+        with self.peer_connection.lock:
+            am_interested = self.peer_connection.am_interested_in_peer
+        # Pieces it has that are only on their way from other peers keep us interested,
+        # check_request_timeouts asks this peer again if those requests stall
+        if am_interested and not self.is_interested_in_peer():
             # No more pieces needed from this peer
             self.send_not_interested()
 
+    def send_request(self, piece_index):
+        message = (5).to_bytes(4, 'big') + b'\x06' + piece_index.to_bytes(4, 'big')  # Request message
+        # Record the request first, the piece can arrive before sendall returns
+        with self.peer_connection.lock:
+            self.peer_connection.pending_requests[piece_index] = time.monotonic()
+        self.peer_connection.socket.sendall(message)
+        print(f"Requested piece {piece_index} from Peer {self.peer_connection.peer_id}")
+        log_event(self.swarm.log_id, f"Peer {self.swarm.peer_id} requested piece {piece_index} from Peer {self.peer_connection.peer_id}")
+
+    @profiler.timed('MessageHandler.select_piece')
     def select_piece(self):
-        with self.peer_process.bitfield_manager.lock:
-            local_bitfield = self.peer_process.bitfield_manager.local_bitfield.copy()
+        # In streaming mode most requests follow the read head, the rest stay random for swarm health
+        if self.swarm.streaming_mode and random.random() >= self.swarm.config['streaming_random_ratio']:
+            piece_index = self.select_streaming_piece()
+            if piece_index is not None:
+                return piece_index
+        with self.swarm.bitfield_manager.lock:
+            local_bitfield = self.swarm.bitfield_manager.local_bitfield.copy()
         with self.peer_connection.lock:
             peer_bitfield = self.peer_connection.peer_bitfield.copy()
+        # Pieces waiting for the disk writer are received already, and requested ones are on their way
+        pending_writes = self.swarm.disk_writer.pending_pieces(self.swarm)
+        requested = self.swarm.requested_pieces()
         missing_pieces = [
-            index for index in range(self.peer_process.num_pieces)
+            index for index in range(self.swarm.num_pieces)
             if local_bitfield[index] == 0 and peer_bitfield[index] == 1
+            and index not in pending_writes and index not in requested
         ]
         if missing_pieces:
             return random.choice(missing_pieces)
         return None
 
+    def select_streaming_piece(self):
+        """
+        Pick the first piece in the lookahead window after the read head that this peer can send us
+        and that is not already on its way from another peer.
+        """
+        bitfield_manager = self.swarm.bitfield_manager
+        start = max(self.swarm.read_head, bitfield_manager.contiguous_pieces())
+        end = min(start + self.swarm.config['streaming_lookahead'], self.swarm.num_pieces)
+        with bitfield_manager.lock:
+            local_window = bitfield_manager.local_bitfield[start:end]
+        with self.peer_connection.lock:
+            peer_window = self.peer_connection.peer_bitfield[start:end]
+        pending_writes = self.swarm.disk_writer.pending_pieces(self.swarm)
+        requested = self.swarm.requested_pieces()
+        for offset, (have, peer_has) in enumerate(zip(local_window, peer_window)):
+            index = start + offset
+            if have == 0 and peer_has == 1 and index not in pending_writes and index not in requested:
+                return index
+        return None
+
     def send_piece(self, piece_index):
         piece_data = self.get_piece(piece_index)
         if piece_data is None:
@@ -222,29 +307,12 @@ class MessageHandler:
         message = (len(piece_data) + 5).to_bytes(4, 'big') + b'\x07' + piece_index.to_bytes(4, 'big') + piece_data
         self.peer_connection.socket.sendall(message)
         print(f"Sent 'piece' {piece_index} to Peer {self.peer_connection.peer_id}")
-        log_event(self.peer_process.peer_id, f"Peer {self.peer_process.peer_id} sent piece {piece_index} to Peer {self.peer_connection.peer_id}")
+        log_event(self.swarm.log_id, f"Peer {self.swarm.peer_id} sent piece {piece_index} to Peer {self.peer_connection.peer_id}")
 
+    @profiler.timed('MessageHandler.get_piece')
     def get_piece(self, piece_index):
-        # Adjust the path to where your pieces are stored
-        piece_filename = f"{piece_index}{self.peer_process.file_extension}"
-        piece_path = os.path.join(f"peer_{self.peer_process.peer_id}", "pieces", piece_filename)
         try:
-            with open(piece_path, 'rb') as piece_file:
+            with open(self.swarm.piece_path(piece_index), 'rb') as piece_file:
                 return piece_file.read()
         except FileNotFoundError:
             return None
-
-    def save_piece(self, piece_index, piece_data):
-        try:
-            dir_path = f"peer_{self.peer_process.peer_id}/pieces"
-            if not os.path.exists(dir_path):
-                os.makedirs(dir_path)
-            piece_filename = f"{piece_index}{self.peer_process.file_extension}"  # Use the file extension
-            piece_path = os.path.join(dir_path, piece_filename)
-            with open(piece_path, 'wb') as piece_file:
-                piece_file.write(piece_data)
-            print(f"Saved piece {piece_index} to {piece_path}")
-        except IOError as e:
-            print(f"Error saving piece {piece_index}: {e}")
-            log_event(self.peer_process.peer_id, f"Error saving piece {piece_index}: {e}")
-
@@ -2,79 +2,41 @@ import os
 import sys
 import socket
 import threading
-import random
+import signal
 import time
-from datetime import datetime
-from bitfield_manager import BitfieldManager
-from message_handler import MessageHandler
-from utils import recv_all, log_event
+from message_handler import MessageHandler, HANDSHAKE_KEEP_ALIVES
+from disk_writer import DiskWriter
+from peer_link import PeerLink
+from swarm import Swarm, DEFAULT_CONTENT_ID
+from stream_reader import stream_server_task
+from utils import log_event
+from profiler import profiler, ProfiledLock
 class PeerProcess:
-    def __init__(self, peer_id, peer_info, config):
+    def __init__(self, peer_id, peer_info, config, swarm_configs=()):
         self.peer_id = peer_id
         self.peer_info = peer_info
         self.config = config
-        self.file_name = self.config['file_name']
-        self.file_extension = os.path.splitext(self.file_name)[1]
         self.host = self.get_host_for_peer(peer_id)
         self.port = self.get_port_for_peer(peer_id)
-        self.connections = {}  # Key: peer_id, Value: PeerConnection instance
-        self.peer_sockets = {}  # Key: peer_id, Value: socket object
-        self.num_pieces = self.calculate_num_pieces(config['file_size'], config['piece_size'])
-        self.bitfield_manager = BitfieldManager(self.num_pieces)
-        self.has_file = self.get_has_file_for_peer(peer_id)
-        self.has_complete_file = self.has_file
-        if self.has_file:
-            self.bitfield_manager.set_all()
-            self.split_file_into_pieces()
-        self.lock = threading.Lock()
+        self.stream_port = self.get_stream_port_for_peer(peer_id)
+        # A single pool of writer threads, however many swarms there are
+        self.disk_writer = DiskWriter(config['disk_writer_threads'], config['disk_queue_size'])
+        # One swarm for the file in Common.cfg and one for each entry of Swarms.cfg
+        self.swarms = {
+            DEFAULT_CONTENT_ID: Swarm(peer_id, DEFAULT_CONTENT_ID, config, self.get_has_file_for_peer(peer_id),
+                                      self.disk_writer)
+        }  # Key: content_id, Value: Swarm instance
+        for swarm_config in swarm_configs:
+            swarm_config_copy = dict(config, file_name=swarm_config['file_name'], file_size=swarm_config['file_size'])
+            has_file = int(peer_id in swarm_config['seeders'])
+            self.swarms[swarm_config['content_id']] = Swarm(peer_id, swarm_config['content_id'], swarm_config_copy, has_file,
+                                                         self.disk_writer)
+        self.links = {}  # Key: peer_id, Value: PeerLink shared by all swarms
+        self.lock = ProfiledLock('PeerProcess.lock')
+        self.stream_socket = None
         self.is_terminated = False
-        self.preferred_neighbors = []
-        self.previous_preferred_neighbors = []
-        self.optimistic_unchoke_neighbor = None
-
-    def split_file_into_pieces(self):
-        # Only split if the peer has the complete file
-        file_path = f"peer_{self.peer_id}/{self.config['file_name']}"
-        if not os.path.exists(file_path):
-            print(f"File {self.config['file_name']} not found in peer_{self.peer_id}/")
-            return
-        # Read the complete file
-        with open(file_path, 'rb') as f:
-            data = f.read()
-        # Split into pieces
-        piece_size = self.config['piece_size']
-        num_pieces = self.num_pieces
-        dir_path = f"peer_{self.peer_id}/pieces"
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-        for i in range(num_pieces):
-            start = i * piece_size
-            end = min(start + piece_size, len(data))
-            piece_data = data[start:end]
-            piece_filename = f"{i}{self.file_extension}"  # Use the file extension
-            piece_path = os.path.join(dir_path, piece_filename)
-            with open(piece_path, 'wb') as piece_file:
-                piece_file.write(piece_data)
-        print(f"Split file into {num_pieces} pieces in {dir_path}")
-
-    def assemble_file_from_pieces(self):
-        dir_path = f"peer_{self.peer_id}/pieces"
-        file_path = f"peer_{self.peer_id}/{self.config['file_name']}"
-        with open(file_path, 'wb') as outfile:
-            for i in range(self.num_pieces):
-                piece_filename = f"{i}{self.file_extension}"  # Use the file extension
-                piece_path = os.path.join(dir_path, piece_filename)
-                with open(piece_path, 'rb') as infile:
-                    outfile.write(infile.read())
-        print(f"Reconstructed file saved at {file_path}")
-        self.has_complete_file = True  # Update the flag
-        log_event(self.peer_id, f"Peer {self.peer_id} has downloaded the complete file.")
-
-    def calculate_num_pieces(self, file_size, piece_size):
-        """
-        Calculate the number of pieces based on the file size and piece size.
-        """
-        return (file_size + piece_size - 1) // piece_size
+        self.budget_offset = 0  # Swarm that gets the first unchoke slot, rotates every interval
+        self.optimistic_offset = 0  # Swarm that gets the next optimistic unchoke, rotates every interval
 
     def get_host_for_peer(self, peer_id):
         for peer in self.peer_info:
@@ -88,33 +50,77 @@ class PeerProcess:
                 return peer['port']
         return None
 
+    def get_stream_port_for_peer(self, peer_id):
+        for peer in self.peer_info:
+            if peer['peer_id'] == peer_id:
+                return peer.get('stream_port', 0)
+        return None
+
     def get_has_file_for_peer(self, peer_id):
         for peer in self.peer_info:
             if peer['peer_id'] == peer_id:
                 return peer['has_file']
         return None
 
+    def log_to_all_swarms(self, message):
+        for swarm in self.swarms.values():
+            log_event(swarm.log_id, message)
+
     def start(self):
-        # Start listening for incoming connections
+        # Start listening for incoming connections, shared by all swarms
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
-        print(f"Peer {self.peer_id} listening on port {self.port}")
+        print(f"Peer {self.peer_id} listening on port {self.port} for {len(self.swarms)} swarm(s)")
+
+        # Toggle the profiler with `kill -USR1 <pid>` (not available on Windows)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.handle_profile_signal)
 
         # Start a thread to accept incoming connections
-        threading.Thread(target=self.accept_incoming_connections, daemon=True).start()
+        threading.Thread(target=self.accept_incoming_connections, name="accept", daemon=True).start()
+
+        # Serve the file from Common.cfg to local consumers while it downloads
+        if self.stream_port:
+            self.stream_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.stream_socket.bind(('127.0.0.1', self.stream_port))
+            self.stream_socket.listen(5)
+            print(f"Peer {self.peer_id} streaming its file on port {self.stream_port}")
+            threading.Thread(target=stream_server_task, args=(self.swarms[DEFAULT_CONTENT_ID], self.stream_socket),
+                             name="stream-server", daemon=True).start()
 
         # Connect to peers that started earlier
         self.connect_to_peers()
 
-        threading.Thread(target=self.unchoking_task, daemon=True).start()
-        threading.Thread(target=self.optimistic_unchoking_task, daemon=True).start()
+        threading.Thread(target=self.unchoking_task, name="unchoking", daemon=True).start()
+        threading.Thread(target=self.optimistic_unchoking_task, name="optimistic-unchoking", daemon=True).start()
+        # Keep-alives and request deadlines
+        threading.Thread(target=self.timeout_check_task, name="timeout-check", daemon=True).start()
         # Start the completion check task
-        threading.Thread(target=self.completion_check_task, daemon=True).start()
+        threading.Thread(target=self.completion_check_task, name="completion-check", daemon=True).start()
         # Main loop
         while True:
             time.sleep(1)  # Prevents busy waiting
 
+    def open_stream(self, content_id=DEFAULT_CONTENT_ID, timeout=None):
+        """
+        Open a file object over the downloaded prefix of a swarm's file, see StreamReader.
+        """
+        return self.swarms[content_id].open_stream(timeout)
+
+    def handle_profile_signal(self, signum, frame):
+        self.toggle_profiling()
+
+    def toggle_profiling(self):
+        reports = profiler.toggle(self.peer_id)
+        if profiler.enabled:
+            print(f"Peer {self.peer_id} started profiling")
+            log_event(self.peer_id, f"Peer {self.peer_id} started profiling.")
+        elif reports:
+            folded_path, summary_path = reports
+            print(f"Peer {self.peer_id} stopped profiling, wrote {folded_path} and {summary_path}")
+            log_event(self.peer_id, f"Peer {self.peer_id} stopped profiling, wrote {folded_path} and {summary_path}.")
+
     def unchoking_task(self):
         while True:
             try:
@@ -123,86 +129,35 @@ class PeerProcess:
             except Exception as e:
                 print(f"Error in unchoking_task: {e}")
 
-    # def select_preferred_neighbors(self):
-    #     with self.lock:
-    #         interested_peers = []
-    #         for conn in self.connections.values():
-    #             with conn.lock:
-    #                 if conn.is_interested_in_us:
-    #                     interested_peers.append(conn)
-    #         k = self.config['num_preferred_neighbors']
-    #
-    #         if self.has_file:
-    #             # Peer has the complete file, select randomly
-    #             preferred_neighbors = random.sample(interested_peers, min(k, len(interested_peers)))
-    #         else:
-    #             # Peer does not have the complete file, select based on download rates
-    #             # Sort interested peers by download rate in descending order
-    #             sorted_peers = sorted(interested_peers, key=lambda x: x.download_rate, reverse=True)
-    #             preferred_neighbors = sorted_peers[:k]
-    #
-    #         # Store the preferred neighbors
-    #         self.preferred_neighbors = preferred_neighbors
-    #
-    #         # Update choked status
-    #         for conn in self.connections.values():
-    #             if conn in self.preferred_neighbors or (self.optimistic_unchoke_neighbor == conn.peer_id):
-    #                 if conn.is_choked:
-    #                     conn.send_unchoke()
-    #             else:
-    #                 if not conn.is_choked:
-    #                     conn.send_choke()
-    #
-    #         # Log the preferred neighbors
-    #         neighbor_ids = [conn.peer_id for conn in self.preferred_neighbors]
-    #         log_event(self.peer_id, f"Peer {self.peer_id} has the preferred neighbors {neighbor_ids}")
-    #
-    #         # Reset download rates for the next interval
-    #         for conn in self.connections.values():
-    #             conn.download_rate = conn.downloaded_bytes / self.config['unchoking_interval']
-    #             conn.downloaded_bytes = 0
     def select_preferred_neighbors(self):
-        with self.lock:
-            interested_peers = []
-            for conn in self.connections.values():
-                with conn.lock:
-                    if conn.is_interested_in_us:
-                        interested_peers.append(conn)
-            k = self.config['num_preferred_neighbors']
-
-            if self.has_complete_file:
-                # Peer has the complete file, select randomly
-                preferred_neighbors = random.sample(interested_peers, min(k, len(interested_peers)))
-            else:
-                # Peer does not have the complete file, select based on download rates
-                sorted_peers = sorted(interested_peers, key=lambda x: x.download_rate, reverse=True)
-                preferred_neighbors = sorted_peers[:k]
-
-            # Compare with previous preferred neighbors
-            neighbor_ids = [conn.peer_id for conn in preferred_neighbors]
-            previous_neighbor_ids = [conn.peer_id for conn in self.previous_preferred_neighbors]
-
-            if set(neighbor_ids) != set(previous_neighbor_ids):
-                # Preferred neighbors have changed, log the event
-                log_event(self.peer_id, f"Peer {self.peer_id} has the preferred neighbors {neighbor_ids}")
-                self.previous_preferred_neighbors = preferred_neighbors.copy()
-
-            # Store the preferred neighbors
-            self.preferred_neighbors = preferred_neighbors
-
-            # Update choked status
-            for conn in self.connections.values():
-                if conn in self.preferred_neighbors or (self.optimistic_unchoke_neighbor == conn.peer_id):
-                    if conn.is_choked:
-                        conn.send_unchoke()
-                else:
-                    if not conn.is_choked:
-                        conn.send_choke()
+        # Split the unchoke budget between the swarms
+        budgets = self.split_unchoke_budget()
+        for content_id, swarm in self.swarms.items():
+            swarm.select_preferred_neighbors(budgets[content_id])
 
-            # Reset download rates for the next interval
-            for conn in self.connections.values():
-                conn.download_rate = conn.downloaded_bytes / self.config['unchoking_interval']
-                conn.downloaded_bytes = 0
+    def split_unchoke_budget(self):
+        """
+        Hand out the NumberOfPreferredNeighbors slots one at a time, round-robin over the swarms that still have
+        interested peers without a slot. The swarm that goes first rotates every interval, so when there are more
+        swarms than slots each one gets its turn.
+        """
+        content_ids = list(self.swarms)
+        demand = {content_id: self.swarms[content_id].count_interested_peers() for content_id in content_ids}
+        budgets = {content_id: 0 for content_id in content_ids}
+        remaining = self.config['num_preferred_neighbors']
+        start = self.budget_offset % len(content_ids)
+        self.budget_offset += 1
+        order = content_ids[start:] + content_ids[:start]
+        while remaining > 0:
+            handed_out = False
+            for content_id in order:
+                if remaining > 0 and budgets[content_id] < demand[content_id]:
+                    budgets[content_id] += 1
+                    remaining -= 1
+                    handed_out = True
+            if not handed_out:
+                break
+        return budgets
 
     def accept_incoming_connections(self):
         while not self.is_terminated:
@@ -227,24 +182,25 @@ class PeerProcess:
                 break  # Exit the loop on unexpected exceptions
 
     def handle_incoming_connection(self, client_socket):
-        from peer_connection import PeerConnection
         # Receive handshake
-        peer_id = MessageHandler.receive_handshake(client_socket)
+        peer_id, content_id, flags = MessageHandler.receive_handshake(client_socket)
         if peer_id is None:
             print("Invalid handshake received. Closing connection.")
             client_socket.close()
             return
+        if content_id not in self.swarms:
+            print(f"Handshake from Peer {peer_id} is for unknown swarm {content_id}. Closing connection.")
+            client_socket.close()
+            return
         print(f"Received handshake from Peer {peer_id}")
-        log_event(self.peer_id, f"Peer {self.peer_id} is connected from Peer {peer_id}")
+        self.log_to_all_swarms(f"Peer {self.peer_id} is connected from Peer {peer_id}")
 
         # Send handshake back
-        MessageHandler.send_handshake(client_socket, self.peer_id)
+        MessageHandler.send_handshake(client_socket, self.peer_id, content_id)
         print(f"Sent handshake to Peer {peer_id}")
 
-        # Create a PeerConnection instance
-        peer_connection = PeerConnection(peer_id, client_socket, self)
-        with self.lock:
-            self.connections[peer_id] = peer_connection
+        # Create a PeerLink carrying all swarms
+        self.add_link(PeerLink(peer_id, client_socket, self, content_id, bool(flags & HANDSHAKE_KEEP_ALIVES)))
 
     def connect_to_peers(self):
         for peer in self.peer_info:
@@ -252,32 +208,39 @@ class PeerProcess:
                 threading.Thread(target=self.establish_connection, args=(peer,), daemon=True).start()
 
     def establish_connection(self, peer):
-        from peer_connection import PeerConnection
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((peer['host'], peer['port']))
             print(f"Peer {self.peer_id} connected to Peer {peer['peer_id']}")
-            log_event(self.peer_id, f"Peer {self.peer_id} makes a connection to Peer {peer['peer_id']}")
+            self.log_to_all_swarms(f"Peer {self.peer_id} makes a connection to Peer {peer['peer_id']}")
 
             # Send handshake
-            MessageHandler.send_handshake(s, self.peer_id)
+            MessageHandler.send_handshake(s, self.peer_id, DEFAULT_CONTENT_ID)
             print(f"Sent handshake to Peer {peer['peer_id']}")
 
             # Receive handshake
-            received_peer_id = MessageHandler.receive_handshake(s)
-            if received_peer_id != peer['peer_id']:
+            received_peer_id, content_id, flags = MessageHandler.receive_handshake(s)
+            if received_peer_id != peer['peer_id'] or content_id != DEFAULT_CONTENT_ID:
                 print(f"Invalid peer ID received in handshake from Peer {peer['peer_id']}. Closing connection.")
                 s.close()
                 return
             print(f"Received handshake from Peer {received_peer_id}")
 
-            # Create a PeerConnection instance
-            peer_connection = PeerConnection(peer['peer_id'], s, self)
-            with self.lock:
-                self.connections[peer['peer_id']] = peer_connection
+            # Create a PeerLink carrying all swarms
+            self.add_link(PeerLink(peer['peer_id'], s, self, content_id, bool(flags & HANDSHAKE_KEEP_ALIVES)))
         except Exception as e:
             print(f"Error connecting to Peer {peer['peer_id']}: {e}")
 
+    def add_link(self, link):
+        with self.lock:
+            self.links[link.peer_id] = link
+        link.start()
+
+    def remove_link(self, link):
+        with self.lock:
+            if self.links.get(link.peer_id) is link:
+                del self.links[link.peer_id]
+
     # Additional methods for unchoking intervals, optimistic unchoking, etc.
     def optimistic_unchoking_task(self):
         while True:
@@ -288,64 +251,59 @@ class PeerProcess:
                 print(f"Error in optimistic_unchoking_task: {e}")
 
     def select_optimistic_unchoke_neighbor(self):
-        with self.lock:
-            # Find choked and interested peers not in preferred neighbors
-            choked_interested_peers = []
-            for conn in self.connections.values():
-                with conn.lock:
-                    if conn.is_interested_in_us and conn.is_choked and conn not in self.preferred_neighbors:
-                        choked_interested_peers.append(conn)
-
-            if choked_interested_peers:
-                # Randomly select one peer to unchoke
-                optimistic_peer = random.choice(choked_interested_peers)
-                optimistic_peer.send_unchoke()
-                self.optimistic_unchoke_neighbor = optimistic_peer.peer_id
-                log_event(self.peer_id,
-                          f"Peer {self.peer_id} has the optimistically unchoked neighbor {optimistic_peer.peer_id}")
-            else:
-                self.optimistic_unchoke_neighbor = None
+        # A single optimistic slot for the whole process, the swarms take turns
+        content_ids = list(self.swarms)
+        start = self.optimistic_offset % len(content_ids)
+        order = content_ids[start:] + content_ids[:start]
+        chosen = None
+        for content_id in order:
+            if chosen is None and self.swarms[content_id].select_optimistic_unchoke_neighbor():
+                chosen = content_id
+            elif content_id != chosen:
+                self.swarms[content_id].optimistic_unchoke_neighbor = None
+        if chosen is not None:
+            self.optimistic_offset = content_ids.index(chosen) + 1
+
+    def timeout_check_task(self):
+        while not self.is_terminated:
+            try:
+                time.sleep(1)
+                with self.lock:
+                    links = list(self.links.values())
+                for link in links:
+                    try:
+                        link.send_keepalive_if_idle(self.config['keep_alive_interval'])
+                    except OSError as e:
+                        print(f"Error sending keep-alive to Peer {link.peer_id}: {e}")  # The link closed itself
+                for swarm in self.swarms.values():
+                    swarm.check_request_timeouts()
+            except Exception as e:
+                print(f"Error in timeout_check_task: {e}")
 
     def completion_check_task(self):
         while not self.is_terminated:
             time.sleep(5)  # Check every 5 seconds
-            with self.lock:
-                is_complete = self.bitfield_manager.is_complete()
-            if is_complete:
-                all_peers_completed = True
-                for peer in self.peer_info:
-                    peer_id = peer['peer_id']
-                    if peer_id == self.peer_id:
-                        continue  # Skip self
-                    with self.lock:
-                        conn = self.connections.get(peer_id)
-                    if conn:
-                        with conn.lock:
-                            if not conn.has_complete_file:
-                                all_peers_completed = False
-                                break
-                    else:
-                        # Assume the peer has not completed if not connected
-                        all_peers_completed = False
-                        break
-                if all_peers_completed:
-                    self.terminate()
+            if all(swarm.is_done(self.peer_info) for swarm in self.swarms.values()):
+                self.terminate()
 
     def terminate(self):
         if self.is_terminated:
             return
         self.is_terminated = True
         # Log the completion event only if the peer didn't start with the complete file
-        if not self.has_file and self.has_complete_file:
-            log_event(self.peer_id, f"Peer {self.peer_id} has downloaded the complete file.")
+        for swarm in self.swarms.values():
+            if not swarm.has_file and swarm.has_complete_file:
+                log_event(swarm.log_id, f"Peer {self.peer_id} has downloaded the complete file.")
         print(f"Peer {self.peer_id} is terminating.")
-        # Close all connections without holding self.lock
+        # Close all links without holding self.lock
         with self.lock:
-            connections = list(self.connections.values())
-        for conn in connections:
-            conn.close()
+            links = list(self.links.values())
+        for link in links:
+            link.close()
         # Close the server socket
         self.server_socket.close()
+        if self.stream_socket:
+            self.stream_socket.close()
         # Exit the program
         sys.exit(0)
 
@@ -364,20 +322,49 @@ def read_config_files():
         'optimistic_unchoking_interval': int(config['OptimisticUnchokingInterval']),
         'file_name': config['FileName'],
         'file_size': int(config['FileSize']),
-        'piece_size': int(config['PieceSize'])
+        'piece_size': int(config['PieceSize']),
+        'super_seeding': int(config.get('SuperSeeding', 0)),
+        'disk_writer_threads': int(config.get('DiskWriterThreads', 2)),
+        'disk_queue_size': int(config.get('DiskQueueSize', 64)),
+        'streaming_mode': int(config.get('StreamingMode', 0)),
+        'streaming_lookahead': int(config.get('StreamingLookahead', 16)),
+        'streaming_random_ratio': float(config.get('StreamingRandomRatio', 0.2)),
+        'request_timeout': float(config.get('RequestTimeout', 10)),
+        'keep_alive_interval': float(config.get('KeepAliveInterval', 10)),
+        'idle_timeout': float(config.get('IdleTimeout', 30))
     }
 
 
+def read_swarm_config():
+    # Swarms.cfg is optional, each line adds a swarm: <content_id> <file_name> <file_size> <seeder_id>[,<seeder_id>...]
+    swarm_configs = []
+    if not os.path.exists('Swarms.cfg'):
+        return swarm_configs
+    with open('Swarms.cfg', 'r') as file:
+        for line in file:
+            if line.strip():  # Ignore empty lines
+                content_id, file_name, file_size, seeders = line.strip().split()
+                swarm_configs.append({
+                    'content_id': int(content_id),
+                    'file_name': file_name,
+                    'file_size': int(file_size),
+                    'seeders': [int(seeder) for seeder in seeders.split(',')]
+                })
+    return swarm_configs
+
+
 def read_peer_info():
     peer_info = []
     with open('PeerInfo.cfg', 'r') as file:
         for line in file:
-            peer_id, host, port, has_file = line.strip().split()
+            # The stream port is an optional fifth column
+            peer_id, host, port, has_file, *stream_port = line.strip().split()
             peer_info.append({
                 'peer_id': int(peer_id),
                 'host': host,
                 'port': int(port),
-                'has_file': int(has_file)
+                'has_file': int(has_file),
+                'stream_port': int(stream_port[0]) if stream_port else 0
             })
     return peer_info
 
@@ -387,6 +374,7 @@ if __name__ == "__main__":
     peer_id = int(sys.argv[1])
     config = read_config_files()
     peer_info = read_peer_info()
+    swarm_configs = read_swarm_config()
 
-    peer = PeerProcess(peer_id, peer_info, config)
+    peer = PeerProcess(peer_id, peer_info, config, swarm_configs)
     peer.start()
@@ -1,83 +1,91 @@
 import threading
 from message_handler import MessageHandler
-from utils import recv_all, log_event
+from utils import log_event
+
+MIN_REQUEST_TIMEOUT = 0.5  # Seconds, lower bound for the deadline of a request
+MAX_TIMEOUT_BACKOFF = 8  # The deadline of a peer doubles with each stall, up to this factor
 
 class PeerConnection:
-    def __init__(self, peer_id, socket, peer_process):
+    def __init__(self, peer_id, socket, swarm):
         self.peer_id = peer_id
         self.socket = socket
-        self.peer_process = peer_process
+        self.swarm = swarm
         self.is_choked = True
         self.peer_choking = True
         # self.is_interested = False
         self.is_interested_in_us = False  # Remote peer is interested in us
         self.am_interested_in_peer = False  # We are interested in the remote peer
-        self.peer_bitfield = [0] * self.peer_process.num_pieces
-        self.pending_requests = []
+        self.peer_bitfield = [0] * self.swarm.num_pieces
+        self.pending_requests = {}  # Key: piece index, Value: time the request was sent
+        self.srtt = None  # Smoothed time from request to piece, in seconds
+        self.rttvar = None  # Variation of that time, in seconds
+        self.timeout_backoff = 1
         self.lock = threading.Lock()
         self.message_handler = MessageHandler(self)
         self.downloaded_bytes = 0  # Bytes downloaded in the current interval
         self.download_rate = 0  # Download rate in bytes per second
         self.has_complete_file = False  # Indicates if the peer has the complete file
-        # Send bitfield
+        # Send bitfield, the PeerLink this connection runs over reads and dispatches the replies
         self.send_bitfield()
-        print(f"Sent bitfield to Peer {self.peer_id}")
-
-        # Start a thread to handle messages from this peer
-        threading.Thread(target=self.handle_messages, daemon=True).start()
-
-
 
     def send_bitfield(self):
-        bitfield_message = self.peer_process.bitfield_manager.generate_bitfield_message()
+        super_seeder = self.swarm.super_seeder
+        if super_seeder and super_seeder.active:
+            bitfield_message = super_seeder.generate_bitfield_message()
+        else:
+            bitfield_message = self.swarm.bitfield_manager.generate_bitfield_message()
         self.socket.sendall(bitfield_message)
         print(f"Sent bitfield to Peer {self.peer_id}")
 
-    def handle_messages(self):
-        while True:
-            try:
-                # Read the message length
-                length_bytes = recv_all(self.socket, 4)
-                if not length_bytes:
-                    print(f"Connection to Peer {self.peer_id} closed.")
-                    break
-                message_length = int.from_bytes(length_bytes, 'big')
+    def record_round_trip(self, sample):
+        """
+        Fold the time a request took into the latency estimate. The caller holds self.lock.
+        """
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.timeout_backoff = 1
 
-                # Read the message type
-                message_type_byte = recv_all(self.socket, 1)
-                if not message_type_byte:
-                    print(f"Connection to Peer {self.peer_id} closed.")
-                    break
-                message_type = message_type_byte[0]
+    def request_timeout(self):
+        """
+        Seconds to wait for a requested piece, derived from the measured latency of this peer like TCP's RTO.
+        Until the first piece arrives the configured RequestTimeout is used.
+        """
+        max_timeout = self.swarm.config['request_timeout']
+        with self.lock:
+            if self.srtt is None:
+                return max_timeout
+            timeout = (self.srtt + 4 * self.rttvar) * self.timeout_backoff
+        return min(max(timeout, MIN_REQUEST_TIMEOUT), max_timeout)
+
+    def expire_requests(self, now):
+        """
+        Drop the requests that are past their deadline and return their piece indexes.
+        """
+        timeout = self.request_timeout()
+        with self.lock:
+            stalled = [
+                piece_index for piece_index, requested_at in self.pending_requests.items()
+                if now - requested_at > timeout
+            ]
+            for piece_index in stalled:
+                del self.pending_requests[piece_index]
+            if stalled:
+                self.timeout_backoff = min(self.timeout_backoff * 2, MAX_TIMEOUT_BACKOFF)
+        return stalled
 
-                # Read the message payload
-                payload_length = message_length - 1
-                payload = b''
-                if payload_length > 0:
-                    payload = recv_all(self.socket, payload_length)
-                    if not payload:
-                        print(f"Connection to Peer {self.peer_id} closed.")
-                        break
+    def is_live(self):
+        return self.socket.is_live()
 
-                # Process the message
-                self.message_handler.handle_message(message_type, payload)
-            except (ConnectionAbortedError, ConnectionResetError, ConnectionError, OSError) as e:
-                print(f"Connection to Peer {self.peer_id} was closed: {e}")
-                # Optionally log the event
-                log_event(self.peer_process.peer_id, f"Connection to Peer {self.peer_id} was closed.")
-                break
-            except Exception as e:
-                print(f"Error handling messages from Peer {self.peer_id}: {e}")
-                import traceback
-                traceback.print_exc()
-                break
+    def handle_disconnect(self):
         # Peer has disconnected
-        with self.peer_process.lock:
-            if self.peer_id in self.peer_process.connections:
-                del self.peer_process.connections[self.peer_id]
-        self.socket.close()
-        print(f"Connection to Peer {self.peer_id} closed.")
-        log_event(self.peer_process.peer_id, f"Peer {self.peer_process.peer_id} disconnected from Peer {self.peer_id}")
+        self.swarm.remove_connection(self)
+        if self.swarm.super_seeder:
+            self.swarm.super_seeder.handle_disconnect(self)
+        log_event(self.swarm.log_id, f"Peer {self.swarm.peer_id} disconnected from Peer {self.peer_id}")
 
     def send_choke(self):
         message = (1).to_bytes(4, 'big') + b'\x00'  # Choke message
@@ -85,7 +93,7 @@ class PeerConnection:
         with self.lock:
             self.is_choked = True
         print(f"Sent 'choke' to Peer {self.peer_id}")
-        log_event(self.peer_process.peer_id, f"Peer {self.peer_process.peer_id} choked Peer {self.peer_id}")
+        log_event(self.swarm.log_id, f"Peer {self.swarm.peer_id} choked Peer {self.peer_id}")
 
     def send_unchoke(self):
         message = (1).to_bytes(4, 'big') + b'\x01'  # Unchoke message
@@ -93,14 +101,4 @@ class PeerConnection:
         with self.lock:
             self.is_choked = False
         print(f"Sent 'unchoke' to Peer {self.peer_id}")
-        log_event(self.peer_process.peer_id, f"Peer {self.peer_process.peer_id} unchoked Peer {self.peer_id}")
-
-    def close(self):
-        try:
-            self.socket.close()
-        except Exception as e:
-            print(f"Error closing connection to Peer {self.peer_id}: {e}")
-            # Remove the connection from self.peer_process.connections without holding self.peer_process.lock
-        with self.peer_process.lock:
-            if self.peer_id in self.peer_process.connections:
-                del self.peer_process.connections[self.peer_id]
+        log_event(self.swarm.log_id, f"Peer {self.swarm.peer_id} unchoked Peer {self.peer_id}")
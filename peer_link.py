@@ -0,0 +1,169 @@
+import threading
+import time
+from socket import SHUT_RDWR, timeout as SocketTimeout
+from peer_connection import PeerConnection
+from utils import recv_all
+
+SWARM_MESSAGE_TYPE = 8  # Payload: 4-byte content id that the following messages belong to
+KEEP_ALIVE_MESSAGE = (0).to_bytes(4, 'big')  # A bare zero length, carries no type and belongs to no swarm
+
+
+class SwarmChannel:
+    """
+    Socket-like handle a PeerConnection sends through. Messages are tagged with the channel's swarm on the shared link.
+    """
+
+    def __init__(self, link, content_id):
+        self.link = link
+        self.content_id = content_id
+
+    def sendall(self, message):
+        self.link.send(self.content_id, message)
+
+    def is_live(self):
+        return self.link.is_live()
+
+
+class PeerLink:
+    """
+    The single TCP connection to a remote peer, shared by every swarm this process hosts.
+    A 'swarm' message switches the swarm that the following messages belong to, and is only sent when
+    it changes. Both sides start on the swarm named in the handshake, so a process hosting a single
+    swarm sends exactly the original protocol. One thread reads the link and dispatches every message
+    to the PeerConnection of its swarm.
+    When both handshakes carry the keep-alive flag, a link that has sent nothing for KeepAliveInterval sends
+    a keep-alive, and a link that has received nothing for IdleTimeout is closed, which disconnects it from
+    every swarm. Peers without the flag never receive a keep-alive and are never closed for being quiet.
+    """
+
+    def __init__(self, peer_id, socket, peer_process, content_id, keep_alives):
+        self.peer_id = peer_id
+        self.socket = socket
+        self.peer_process = peer_process
+        self.send_lock = threading.Lock()
+        self.send_content_id = content_id  # Swarm the remote peer attributes our next message to
+        self.receive_content_id = content_id  # Swarm the next received message belongs to
+        self.connections = {}  # Key: content_id, Value: PeerConnection instance
+        self.is_closed = False
+        self.keep_alives = keep_alives  # The remote peer understands keep-alives and sends them
+        self.idle_timeout = peer_process.config['idle_timeout']
+        self.last_sent = time.monotonic()
+        self.last_received = time.monotonic()
+        if self.keep_alives:
+            # A read that waits longer than this raises, so a dead peer can't block the reader thread forever
+            self.socket.settimeout(self.idle_timeout)
+
+    def start(self):
+        # Every connection sends its bitfield before we read, so no message can arrive for a swarm we have not opened
+        for swarm in self.peer_process.swarms.values():
+            conn = PeerConnection(self.peer_id, SwarmChannel(self, swarm.content_id), swarm)
+            self.connections[swarm.content_id] = conn
+            swarm.add_connection(conn)
+        threading.Thread(target=self.handle_messages, name=f"peer-{self.peer_id}", daemon=True).start()
+
+    def send(self, content_id, message):
+        with self.send_lock:
+            if content_id != self.send_content_id:
+                self.send_frame(
+                    (5).to_bytes(4, 'big') + SWARM_MESSAGE_TYPE.to_bytes(1, 'big') + content_id.to_bytes(4, 'big')
+                )
+                self.send_content_id = content_id
+            self.send_frame(message)
+
+    def send_keepalive_if_idle(self, interval):
+        if not self.keep_alives:
+            return
+        with self.send_lock:
+            if time.monotonic() - self.last_sent < interval:
+                return
+            self.send_frame(KEEP_ALIVE_MESSAGE)
+
+    def send_frame(self, frame):
+        # The caller holds send_lock
+        try:
+            self.socket.sendall(frame)
+        except OSError:
+            # A send that failed or timed out may have written part of the frame, nothing can follow it on this link
+            self.close()
+            raise
+        self.last_sent = time.monotonic()
+
+    def is_live(self):
+        if not self.keep_alives:
+            return not self.is_closed  # Peers without keep-alives may stay quiet for any time
+        return not self.is_closed and time.monotonic() - self.last_received < self.idle_timeout
+
+    def handle_messages(self):
+        while True:
+            try:
+                # Read the message length
+                length_bytes = recv_all(self.socket, 4)
+                if not length_bytes:
+                    print(f"Connection to Peer {self.peer_id} closed.")
+                    break
+                self.last_received = time.monotonic()
+                message_length = int.from_bytes(length_bytes, 'big')
+                if message_length == 0:
+                    continue  # Keep-alive
+
+                # Read the message type
+                message_type_byte = recv_all(self.socket, 1)
+                if not message_type_byte:
+                    print(f"Connection to Peer {self.peer_id} closed.")
+                    break
+                message_type = message_type_byte[0]
+
+                # Read the message payload
+                payload_length = message_length - 1
+                payload = b''
+                if payload_length > 0:
+                    payload = recv_all(self.socket, payload_length)
+                    if not payload:
+                        print(f"Connection to Peer {self.peer_id} closed.")
+                        break
+
+                self.last_received = time.monotonic()
+
+                if message_type == SWARM_MESSAGE_TYPE:
+                    self.receive_content_id = int.from_bytes(payload, 'big')
+                    continue
+
+                # Process the message
+                conn = self.connections.get(self.receive_content_id)
+                if conn:
+                    conn.message_handler.handle_message(message_type, payload)
+                else:
+                    print(f"Dropped message for unknown swarm {self.receive_content_id} from Peer {self.peer_id}")
+            except SocketTimeout:
+                print(f"Connection to Peer {self.peer_id} timed out after {self.idle_timeout}s without data")
+                self.peer_process.log_to_all_swarms(f"Connection to Peer {self.peer_id} timed out.")
+                break
+            except (ConnectionAbortedError, ConnectionResetError, ConnectionError, OSError) as e:
+                print(f"Connection to Peer {self.peer_id} was closed: {e}")
+                # Optionally log the event
+                self.peer_process.log_to_all_swarms(f"Connection to Peer {self.peer_id} was closed.")
+                break
+            except Exception as e:
+                print(f"Error handling messages from Peer {self.peer_id}: {e}")
+                import traceback
+                traceback.print_exc()
+                break
+        self.close()
+        for conn in self.connections.values():
+            conn.handle_disconnect()
+        print(f"Connection to Peer {self.peer_id} closed.")
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        try:
+            # Shut down first so the thread blocked reading the link wakes up
+            self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.socket.close()
+        except Exception as e:
+            print(f"Error closing connection to Peer {self.peer_id}: {e}")
+        self.peer_process.remove_link(self)
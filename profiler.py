@@ -0,0 +1,214 @@
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class _Timer:
+    def __init__(self, profiler, label):
+        self.profiler = profiler
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.label, time.perf_counter() - self.start)
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Profiler:
+    """
+    Sampling profiler plus hot-path timers that can be switched on and off while the peer runs.
+    While disabled, timers and profiled locks only cost a flag check.
+    """
+
+    def __init__(self, sample_interval=0.005):
+        self.sample_interval = sample_interval
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread_timings = []  # One dict per thread, Key: label, Value: [count, total, max]
+        self.stack_counts = defaultdict(int)  # Key: collapsed stack, Value: number of samples
+        self.num_samples = 0
+        self.started_at = None
+        self.sampler_thread = None
+
+    def start(self):
+        with self.lock:
+            if self.enabled:
+                return
+            self.thread_timings = []
+            self.stack_counts = defaultdict(int)
+            self.num_samples = 0
+            self.local = threading.local()
+            self.started_at = time.time()
+            self.enabled = True
+            self.sampler_thread = threading.Thread(target=self.sampling_task, name="profiler-sampler", daemon=True)
+            self.sampler_thread.start()
+
+    def stop(self, peer_id):
+        """
+        Stop profiling and write the collapsed-stack file and the summary table.
+        Returns the paths of the written files, or None if profiling was not running.
+        """
+        with self.lock:
+            if not self.enabled:
+                return None
+            self.enabled = False
+            sampler_thread = self.sampler_thread
+            self.sampler_thread = None
+        sampler_thread.join()
+        return self.write_reports(peer_id)
+
+    def toggle(self, peer_id):
+        if self.enabled:
+            return self.stop(peer_id)
+        self.start()
+        return None
+
+    def timer(self, label):
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, label)
+
+    def timed(self, label):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(label, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def record(self, label, elapsed):
+        # Each thread accumulates into its own dict so timers never contend with each other
+        timings = getattr(self.local, 'timings', None)
+        if timings is None:
+            timings = {}
+            self.local.timings = timings
+            with self.lock:
+                self.thread_timings.append((threading.current_thread().name, timings))
+        stats = timings.get(label)
+        if stats is None:
+            timings[label] = [1, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+
+    def sampling_task(self):
+        own_ident = threading.get_ident()
+        while self.enabled:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, f"thread-{ident}"))
+                stack.reverse()
+                self.stack_counts[';'.join(stack)] += 1
+            self.num_samples += 1
+            time.sleep(self.sample_interval)
+
+    def write_reports(self, peer_id):
+        duration = time.time() - self.started_at
+        folded_path = f"profile_peer_{peer_id}.folded"
+        with open(folded_path, 'w') as f:
+            for stack, count in sorted(self.stack_counts.items()):
+                f.write(f"{stack} {count}\n")
+
+        # Merge per-thread timers, keeping a per-thread row and a total row for every label
+        rows = []
+        totals = {}
+        with self.lock:
+            thread_timings = list(self.thread_timings)
+        for thread_name, timings in thread_timings:
+            for label, (count, total, longest) in list(timings.items()):
+                rows.append((label, thread_name, count, total, longest))
+                merged = totals.setdefault(label, [0, 0.0, 0.0])
+                merged[0] += count
+                merged[1] += total
+                merged[2] = max(merged[2], longest)
+        rows.extend((label, '*', count, total, longest) for label, (count, total, longest) in totals.items())
+        rows.sort(key=lambda row: (-totals[row[0]][1], row[0], row[1] != '*', -row[3]))
+
+        # Leaf frames show where the sampled time is actually spent
+        leaf_counts = defaultdict(int)
+        for stack, count in self.stack_counts.items():
+            leaf_counts[stack.rsplit(';', 1)[-1]] += count
+        top_leaves = sorted(leaf_counts.items(), key=lambda item: item[1], reverse=True)[:20]
+        total_leaf_samples = sum(leaf_counts.values()) or 1
+
+        summary_path = f"profile_peer_{peer_id}.txt"
+        with open(summary_path, 'w') as f:
+            f.write(f"Profile of Peer {peer_id}: {duration:.1f}s, {self.num_samples} sampling rounds\n\n")
+            f.write(f"{'Timer':<45} {'Thread':<30} {'Calls':>9} {'Total ms':>11} {'Mean us':>10} {'Max ms':>9}\n")
+            for label, thread_name, count, total, longest in rows:
+                f.write(f"{label:<45} {thread_name:<30} {count:>9} {total * 1e3:>11.2f} "
+                        f"{total / count * 1e6:>10.1f} {longest * 1e3:>9.2f}\n")
+            f.write(f"\n{'Leaf frame':<60} {'Samples':>9} {'Share':>7}\n")
+            for leaf, count in top_leaves:
+                f.write(f"{leaf:<60} {count:>9} {count / total_leaf_samples:>7.1%}\n")
+        return folded_path, summary_path
+
+
+class ProfiledLock:
+    """
+    Drop-in replacement for threading.Lock that records acquisition wait time while profiling is on.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        # Non-blocking attempts never wait, Condition makes one on every notify to check that it owns the lock
+        if not profiler.enabled or not blocking:
+            return self._lock.acquire(blocking, timeout)
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        profiler.record(f"{self.label} wait", time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+# Shared by every module of the peer so a single toggle covers all threads
+profiler = Profiler()
@@ -0,0 +1,96 @@
+import io
+import threading
+
+
+class StreamReader(io.RawIOBase):
+    """
+    Read-only file object over the downloaded file that serves the pieces on disk while the rest is still arriving.
+    A read returns the downloaded pieces from the current position up to the next missing one, and blocks
+    only while the piece at the position is missing, so reads after a seek don't wait for the pieces
+    before it. Every read moves the read head of the swarm, which streaming mode downloads ahead of.
+    """
+
+    def __init__(self, swarm, timeout=None):
+        super().__init__()
+        self.swarm = swarm
+        self.piece_size = swarm.config['piece_size']
+        self.file_size = swarm.config['file_size']
+        self.timeout = timeout
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.file_size
+        self.position = max(0, min(offset, self.file_size))
+        self.swarm.read_head = self.position // self.piece_size
+        return self.position
+
+    def readable_bytes(self):
+        """
+        Number of bytes from the current position that can be read without blocking.
+        """
+        run_end = self.swarm.bitfield_manager.present_run_end(self.position // self.piece_size)
+        return max(min(run_end * self.piece_size, self.file_size) - self.position, 0)
+
+    def readinto(self, buffer):
+        if self.position >= self.file_size or len(buffer) == 0:
+            return 0
+        piece_index = self.position // self.piece_size
+        self.swarm.read_head = piece_index
+        if not self.swarm.bitfield_manager.wait_for_piece(piece_index, self.timeout):
+            raise TimeoutError(f"Piece {piece_index} did not arrive within {self.timeout}s")
+        # Copy as much of the run of downloaded pieces from the position as fits, one piece file at a time
+        end = self.position + min(len(buffer), self.readable_bytes())
+        copied = 0
+        while self.position < end:
+            piece_index, offset = divmod(self.position, self.piece_size)
+            with open(self.swarm.piece_path(piece_index), 'rb') as piece_file:
+                piece_file.seek(offset)
+                data = piece_file.read(min(self.piece_size - offset, end - self.position))
+            if not data:
+                break
+            buffer[copied:copied + len(data)] = data
+            copied += len(data)
+            self.position += len(data)
+        self.swarm.read_head = self.position // self.piece_size
+        return copied
+
+
+def serve_stream(swarm, client_socket):
+    """
+    Stream the whole file to a local client, sending each piece as soon as the prefix reaches it.
+    """
+    reader = StreamReader(swarm)
+    try:
+        while True:
+            data = reader.read(swarm.config['piece_size'])
+            if not data:
+                break
+            client_socket.sendall(data)
+    except OSError as e:
+        print(f"Stream client of Peer {swarm.peer_id} went away: {e}")
+    finally:
+        reader.close()
+        client_socket.close()
+
+
+def stream_server_task(swarm, server_socket):
+    while True:
+        try:
+            client_socket, addr = server_socket.accept()
+        except OSError:
+            break  # Server socket closed on termination
+        print(f"Streaming file of Peer {swarm.peer_id} to {addr}")
+        threading.Thread(target=serve_stream, args=(swarm, client_socket),
+                         name=f"stream-{addr[1]}", daemon=True).start()
@@ -0,0 +1,114 @@
+import random
+import threading
+from utils import log_event
+
+
+class SuperSeeder:
+    """
+    Super-seeding for a peer that starts with the complete file.
+    Each leecher is shown a single piece through a 'have' message, and is only offered another one
+    once that piece has been seen at another peer. When every piece has reached the swarm at least
+    once, the remaining pieces are announced and the peer falls back to normal seeding.
+    """
+
+    def __init__(self, swarm):
+        self.swarm = swarm
+        self.num_pieces = swarm.num_pieces
+        self.active = True
+        self.lock = threading.Lock()
+        self.availability = [0] * self.num_pieces  # Copies of each piece seen at other peers
+        self.offer_counts = [0] * self.num_pieces  # Times each piece has been offered
+        self.offered = {}  # Key: peer_id, Value: piece index currently offered to that peer
+
+    def generate_bitfield_message(self):
+        # Advertise nothing up front, pieces are revealed one at a time
+        bitfield_bytes = self.swarm.bitfield_manager.encode_bitfield([0] * self.num_pieces)
+        return (1 + len(bitfield_bytes)).to_bytes(4, 'big') + b'\x05' + bitfield_bytes
+
+    def handle_bitfield(self, conn):
+        with self.lock:
+            if not self.active:
+                return
+            for index, has_piece in enumerate(conn.peer_bitfield):
+                if has_piece:
+                    self.availability[index] += 1
+        self.offer_next_piece(conn)
+        self.check_finished()
+
+    def handle_have(self, conn, piece_index):
+        with self.lock:
+            if not self.active:
+                return
+            self.availability[piece_index] += 1
+            # Peers whose offered piece now shows up elsewhere have passed it on
+            spread_to = [
+                peer_id for peer_id, offered_index in self.offered.items()
+                if offered_index == piece_index and peer_id != conn.peer_id
+            ]
+        for peer_id in spread_to:
+            with self.swarm.lock:
+                other_conn = self.swarm.connections.get(peer_id)
+            if other_conn:
+                self.offer_next_piece(other_conn)
+
+        if self.offered.get(conn.peer_id) == piece_index and not self.can_spread(conn, piece_index):
+            # Nobody else is left to pass this piece to, so don't hold the peer back
+            self.offer_next_piece(conn)
+        self.check_finished()
+
+    def handle_disconnect(self, conn):
+        with self.lock:
+            self.offered.pop(conn.peer_id, None)
+
+    def can_spread(self, conn, piece_index):
+        with self.swarm.lock:
+            connections = list(self.swarm.connections.values())
+        for other_conn in connections:
+            if other_conn is conn:
+                continue
+            with other_conn.lock:
+                if other_conn.peer_bitfield[piece_index] == 0:
+                    return True
+        return False
+
+    def offer_next_piece(self, conn):
+        with conn.lock:
+            peer_bitfield = conn.peer_bitfield.copy()
+        with self.lock:
+            if not self.active:
+                return
+            candidates = [index for index in range(self.num_pieces) if peer_bitfield[index] == 0]
+            if not candidates:
+                self.offered.pop(conn.peer_id, None)
+                return
+            # Prefer the pieces the swarm has seen least, counting outstanding offers
+            lowest = min(self.availability[index] + self.offer_counts[index] for index in candidates)
+            piece_index = random.choice([
+                index for index in candidates
+                if self.availability[index] + self.offer_counts[index] == lowest
+            ])
+            self.offered[conn.peer_id] = piece_index
+            self.offer_counts[piece_index] += 1
+        conn.message_handler.send_have(piece_index)
+
+    def check_finished(self):
+        with self.lock:
+            if not self.active or not all(self.availability):
+                return
+            self.active = False
+            self.offered.clear()
+        print(f"Peer {self.swarm.peer_id} finished super-seeding, switching to normal seeding")
+        log_event(self.swarm.log_id,
+                  f"Peer {self.swarm.peer_id} finished super-seeding and switched to normal seeding.")
+        # Reveal everything that was held back
+        with self.swarm.lock:
+            connections = list(self.swarm.connections.values())
+        for conn in connections:
+            with conn.lock:
+                missing_pieces = [index for index, has_piece in enumerate(conn.peer_bitfield) if not has_piece]
+            for piece_index in missing_pieces:
+                try:
+                    conn.message_handler.send_have(piece_index)
+                except OSError as e:
+                    print(f"Error sending 'have' message to Peer {conn.peer_id}: {e}")
+                    break
@@ -0,0 +1,266 @@
+import os
+import random
+import time
+from bitfield_manager import BitfieldManager
+from super_seeder import SuperSeeder
+from stream_reader import StreamReader
+from utils import log_event
+from profiler import profiler, ProfiledLock
+
+DEFAULT_CONTENT_ID = 0  # The file from Common.cfg
+
+
+class Swarm:
+    """
+    Everything a peer keeps for one shared file: its bitfield, storage, log, and the connections to the
+    other peers sharing it. A PeerProcess hosts one Swarm per file, and all of them share its DiskWriter.
+    """
+
+    def __init__(self, peer_id, content_id, config, has_file, disk_writer):
+        self.peer_id = peer_id
+        self.content_id = content_id
+        self.config = config
+        self.file_name = self.config['file_name']
+        self.file_extension = os.path.splitext(self.file_name)[1]
+        # The file from Common.cfg keeps the original layout, every other swarm gets its own pieces directory and log
+        if content_id == DEFAULT_CONTENT_ID:
+            self.pieces_dir = f"peer_{peer_id}/pieces"
+            self.log_id = peer_id
+        else:
+            self.pieces_dir = f"peer_{peer_id}/pieces_{content_id}"
+            self.log_id = f"{peer_id}_{content_id}"
+        self.connections = {}  # Key: peer_id, Value: PeerConnection instance
+        self.num_pieces = self.calculate_num_pieces(config['file_size'], config['piece_size'])
+        self.bitfield_manager = BitfieldManager(self.num_pieces)
+        self.has_file = has_file
+        self.has_complete_file = self.has_file
+        if self.has_file:
+            self.bitfield_manager.set_all()
+            self.split_file_into_pieces()
+        # Super-seeding only makes sense for a peer that starts with the complete file
+        self.super_seeder = SuperSeeder(self) if self.has_file and config['super_seeding'] else None
+        self.lock = ProfiledLock('Swarm.lock')
+        self.disk_writer = disk_writer
+        os.makedirs(self.pieces_dir, exist_ok=True)
+        self.streaming_mode = config['streaming_mode']
+        self.read_head = 0  # Piece the stream reader is at, streaming mode downloads ahead of it
+        self.preferred_neighbors = []
+        self.previous_preferred_neighbors = []
+        self.optimistic_unchoke_neighbor = None
+
+    @profiler.timed('Swarm.split_file_into_pieces')
+    def split_file_into_pieces(self):
+        # Only split if the peer has the complete file
+        file_path = f"peer_{self.peer_id}/{self.config['file_name']}"
+        if not os.path.exists(file_path):
+            print(f"File {self.config['file_name']} not found in peer_{self.peer_id}/")
+            return
+        # Read the complete file
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        # Split into pieces
+        piece_size = self.config['piece_size']
+        num_pieces = self.num_pieces
+        if not os.path.exists(self.pieces_dir):
+            os.makedirs(self.pieces_dir)
+        for i in range(num_pieces):
+            start = i * piece_size
+            end = min(start + piece_size, len(data))
+            piece_data = data[start:end]
+            with open(self.piece_path(i), 'wb') as piece_file:
+                piece_file.write(piece_data)
+        print(f"Split file into {num_pieces} pieces in {self.pieces_dir}")
+
+    @profiler.timed('Swarm.assemble_file_from_pieces')
+    def assemble_file_from_pieces(self):
+        file_path = f"peer_{self.peer_id}/{self.config['file_name']}"
+        with open(file_path, 'wb') as outfile:
+            for i in range(self.num_pieces):
+                with open(self.piece_path(i), 'rb') as infile:
+                    outfile.write(infile.read())
+        print(f"Reconstructed file saved at {file_path}")
+        self.has_complete_file = True  # Update the flag
+        log_event(self.log_id, f"Peer {self.peer_id} has downloaded the complete file.")
+
+    def piece_path(self, piece_index):
+        piece_filename = f"{piece_index}{self.file_extension}"  # Use the file extension
+        return os.path.join(self.pieces_dir, piece_filename)
+
+    def open_stream(self, timeout=None):
+        """
+        Open a file object over the downloaded prefix of the file, see StreamReader.
+        """
+        return StreamReader(self, timeout)
+
+    def requested_pieces(self):
+        with self.lock:
+            connections = list(self.connections.values())
+        requested = set()
+        for conn in connections:
+            with conn.lock:
+                requested.update(conn.pending_requests)
+        return requested
+
+    def check_request_timeouts(self):
+        """
+        Expire requests that are past their peer's deadline and hand each stalled piece to another peer that has it.
+        """
+        now = time.monotonic()
+        with self.lock:
+            connections = list(self.connections.values())
+        expired = False
+        for conn in connections:
+            for piece_index in conn.expire_requests(now):
+                expired = True
+                print(f"Request for piece {piece_index} to Peer {conn.peer_id} timed out")
+                log_event(self.log_id, f"Peer {self.peer_id} timed out waiting for piece {piece_index} from Peer {conn.peer_id}")
+                self.reassign_request(piece_index, conn, connections)
+        if not expired:
+            return
+        # Pieces only get requested when a message arrives, so restart every unchoked connection left without a request,
+        # the stalled ones included. Otherwise a piece that only a stalled peer has would never be asked for again.
+        for conn in connections:
+            with conn.lock:
+                idle = not conn.peer_choking and not conn.pending_requests
+            if idle and conn.is_live():
+                try:
+                    conn.message_handler.request_piece()
+                except OSError as e:
+                    print(f"Error requesting a piece from Peer {conn.peer_id}: {e}")
+
+    def reassign_request(self, piece_index, stalled_conn, connections):
+        if self.bitfield_manager.has_piece(piece_index) or self.disk_writer.is_pending(self, piece_index):
+            return  # Arrived after all
+        candidates = []
+        for conn in connections:
+            if conn is stalled_conn or not conn.is_live():
+                continue
+            with conn.lock:
+                if (not conn.peer_choking and conn.peer_bitfield[piece_index] == 1
+                        and piece_index not in conn.pending_requests):
+                    candidates.append((len(conn.pending_requests), conn))
+        if not candidates:
+            return  # Nobody else can send it right now, check_request_timeouts asks the idle connections again
+        # The least busy peer gets it
+        conn = min(candidates, key=lambda candidate: candidate[0])[1]
+        try:
+            conn.message_handler.send_request(piece_index)
+        except OSError as e:
+            print(f"Error reassigning piece {piece_index} to Peer {conn.peer_id}: {e}")
+            return
+        log_event(self.log_id, f"Peer {self.peer_id} reassigned piece {piece_index} from Peer {stalled_conn.peer_id} to Peer {conn.peer_id}")
+
+    def calculate_num_pieces(self, file_size, piece_size):
+        """
+        Calculate the number of pieces based on the file size and piece size.
+        """
+        return (file_size + piece_size - 1) // piece_size
+
+    def add_connection(self, conn):
+        with self.lock:
+            self.connections[conn.peer_id] = conn
+
+    def remove_connection(self, conn):
+        with self.lock:
+            if self.connections.get(conn.peer_id) is conn:
+                del self.connections[conn.peer_id]
+
+    def count_interested_peers(self):
+        with self.lock:
+            connections = list(self.connections.values())
+        count = 0
+        for conn in connections:
+            with conn.lock:
+                if conn.is_interested_in_us and conn.is_live():
+                    count += 1
+        return count
+
+    def select_preferred_neighbors(self, k):
+        with self.lock:
+            # Only live peers are worth an unchoke slot
+            interested_peers = []
+            for conn in self.connections.values():
+                with conn.lock:
+                    if conn.is_interested_in_us and conn.is_live():
+                        interested_peers.append(conn)
+
+            if self.has_complete_file:
+                # Peer has the complete file, select randomly
+                preferred_neighbors = random.sample(interested_peers, min(k, len(interested_peers)))
+            else:
+                # Peer does not have the complete file, select based on download rates
+                sorted_peers = sorted(interested_peers, key=lambda x: x.download_rate, reverse=True)
+                preferred_neighbors = sorted_peers[:k]
+
+            # Compare with previous preferred neighbors
+            neighbor_ids = [conn.peer_id for conn in preferred_neighbors]
+            previous_neighbor_ids = [conn.peer_id for conn in self.previous_preferred_neighbors]
+
+            if set(neighbor_ids) != set(previous_neighbor_ids):
+                # Preferred neighbors have changed, log the event
+                log_event(self.log_id, f"Peer {self.peer_id} has the preferred neighbors {neighbor_ids}")
+                self.previous_preferred_neighbors = preferred_neighbors.copy()
+
+            # Store the preferred neighbors
+            self.preferred_neighbors = preferred_neighbors
+
+            # Update choked status
+            for conn in self.connections.values():
+                if conn in self.preferred_neighbors or (self.optimistic_unchoke_neighbor == conn.peer_id):
+                    if conn.is_choked:
+                        conn.send_unchoke()
+                else:
+                    if not conn.is_choked:
+                        conn.send_choke()
+
+            # Reset download rates for the next interval
+            for conn in self.connections.values():
+                conn.download_rate = conn.downloaded_bytes / self.config['unchoking_interval']
+                conn.downloaded_bytes = 0
+
+    def optimistic_unchoke_candidates(self):
+        # Choked and interested peers not in preferred neighbors
+        with self.lock:
+            choked_interested_peers = []
+            for conn in self.connections.values():
+                with conn.lock:
+                    if (conn.is_interested_in_us and conn.is_choked and conn not in self.preferred_neighbors
+                            and conn.is_live()):
+                        choked_interested_peers.append(conn)
+        return choked_interested_peers
+
+    def select_optimistic_unchoke_neighbor(self):
+        """
+        Unchoke a random choked but interested peer. Returns False if there was no candidate.
+        """
+        choked_interested_peers = self.optimistic_unchoke_candidates()
+        if not choked_interested_peers:
+            self.optimistic_unchoke_neighbor = None
+            return False
+        # Randomly select one peer to unchoke
+        optimistic_peer = random.choice(choked_interested_peers)
+        optimistic_peer.send_unchoke()
+        self.optimistic_unchoke_neighbor = optimistic_peer.peer_id
+        log_event(self.log_id,
+                  f"Peer {self.peer_id} has the optimistically unchoked neighbor {optimistic_peer.peer_id}")
+        return True
+
+    def is_done(self, peer_info):
+        """
+        True once we and every other peer in peer_info have the complete file.
+        """
+        if not self.bitfield_manager.is_complete():
+            return False
+        for peer in peer_info:
+            peer_id = peer['peer_id']
+            if peer_id == self.peer_id:
+                continue  # Skip self
+            with self.lock:
+                conn = self.connections.get(peer_id)
+            if not conn:
+                # Assume the peer has not completed if not connected
+                return False
+            with conn.lock:
+                if not conn.has_complete_file:
+                    return False
+        return True
@@ -1,6 +1,8 @@
 import os
 from datetime import datetime
+from profiler import profiler
 
+@profiler.timed('utils.recv_all')
 def recv_all(sock, length):
     data = b''
     while len(data) < length:
@@ -11,6 +13,7 @@ def recv_all(sock, length):
     return data
 
 
+@profiler.timed('utils.log_event')
 def log_event(peer_id, message):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     log_message = f"[{timestamp}]: {message}\n"